@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import heapq
+import itertools
 import logging
-import random
+import os
 import re
 import selectors
 import socket
@@ -12,18 +14,32 @@ import time
 from _collections_abc import Iterable
 from enum import Enum
 from os import environ
+from typing import cast
 
 # Note: You can set PIRC_LOG_LEVEL=10 to enable DEBUG (10) level logging
+# Note: Use log.debug("...%s", value) rather than f-strings, so messages are only formatted when DEBUG is enabled
 log = logging.getLogger("pirc")
 logging.basicConfig(level = int(environ.get("PIRC_LOG_LEVEL", logging.INFO)))
 
 # Generic select-based TCP server
 class TcpServer:
-    def __init__(self, host="localhost", port=1234, max_message_size=1000, max_pending_clients=5) -> None:
+    def __init__(self, host="localhost", port=1234, max_message_size=1000, max_pending_clients=5, max_send_queue=65536) -> None:
         self.host = host
         self.port = port
         self.max_pending_clients = max_pending_clients
         self.max_message_size = max_message_size
+        self.max_send_queue = max_send_queue
+        # Shared by all reads, so receiving doesn't allocate a new buffer each time
+        self.receive_buffer = memoryview(bytearray(max_message_size))
+        # Data that couldn't be sent immediately, per client (written out once the socket is writable)
+        self.send_queues: dict[socket.socket, bytearray] = dict()
+        # Clients that failed while sending, to be removed once it's safe to do so
+        self.failed_clients: set[socket.socket] = set()
+        # Messages sent while handling the current batch of events, per client (flushed once the batch is done, so
+        # several messages to the same client go out in a single send)
+        self.pending_sends: dict[socket.socket, list[bytes]] = dict()
+        # Data for each connected client (kept here, rather than going through the selector's key map)
+        self.clients: dict[socket.socket, object] = dict()
 
     def run(self) -> None:
         self.listener = socket.socket()
@@ -35,103 +51,261 @@ class TcpServer:
         self.selector.register(self.listener, selectors.EVENT_READ)
         log.info(f"Listening on: {self.host}:{self.port}")
         while True:
-            # Timeout after 30 seconds to check for periodic tasks
-            events = self.selector.select(timeout=30)
-            for key, _mask in events:
-                assert isinstance(key.fileobj, socket.socket)
-                if key.fileobj == self.listener: self.accept()
-                else: self.read(key.fileobj, key.data)
+            # Wake up in time for the next periodic task, even if nothing else happens
+            events = self.selector.select(timeout=self.periodic_timeout())
+            for key, mask in events:
+                # Note: Only sockets are registered, so cast() (which costs nothing at runtime) is enough for type checking
+                client = cast(socket.socket, key.fileobj)
+                if client is self.listener: self.accept()
+                # Note: Skip clients that were disconnected while handling an earlier event
+                elif client.fileno() >= 0:
+                    if mask & selectors.EVENT_WRITE: self.write(client, key.data)
+                    if mask & selectors.EVENT_READ and client.fileno() >= 0: self.read(client, key.data)
+            self.flush()
             # Perform periodic tasks (like sending PINGs)
             self.periodic_tasks()
+            self.flush()
 
     def accept(self) -> None:
-        client, _address = self.listener.accept()
-        client_data = self.create_client_data(client)
-        client.setblocking(False)
-        self.selector.register(client, selectors.EVENT_READ, client_data)
+        # Accept all pending connections, rather than one per select() wake-up
+        while True:
+            try:
+                client, _address = self.listener.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                # Connection was reset before it could be accepted
+                continue
+            try:
+                client.setblocking(False)
+                # Replies are already batched into one send each, so don't let Nagle's algorithm hold small ones back
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as e:
+                # Note: Some platforms fail setsockopt() on a connection the peer has already reset
+                log.warning("Exception while setting up client socket", exc_info=e)
+                client.close()
+                continue
+            client_data = self.create_client_data(client)
+            self.clients[client] = client_data
+            self.selector.register(client, selectors.EVENT_READ, client_data)
     
     def remove_client(self, client: socket.socket) -> None:
+        self.clients.pop(client, None)
+        queue = self.send_queues.pop(client, None)
+        pending = self.pending_sends.pop(client, None)
+        # Make a best-effort attempt to send anything still waiting (e.g. replies to commands sent just before QUIT)
+        # Note: Failed clients never have pending data, since send() doesn't accept any for them
+        if pending:
+            try:
+                client.send(b"".join([queue or b"", *pending]))
+            except OSError:
+                pass
+        self.failed_clients.discard(client)
         self.selector.unregister(client)
         client.close()
+
+    # Note: Removing a failed client can send more messages (e.g. QUIT notices to its channels), so keep going until
+    # nothing is left, rather than leaving them unsent until select() next wakes up
+    def flush(self) -> None:
+        while self.pending_sends or self.failed_clients:
+            self.flush_sends()
+            self.remove_failed_clients()
+
+    # Note: Sends can fail while flushing, so failed clients are only removed once a batch of events has been handled
+    # (when nothing is iterating over the clients)
+    def remove_failed_clients(self) -> None:
+        while self.failed_clients:
+            client = self.failed_clients.pop()
+            if client.fileno() >= 0:
+                self.remove_client(client)
             
     def read(self, client: socket.socket, client_data) -> None:
         try:
-            message = client.recv(self.max_message_size)
-            if not message: raise ConnectionError()
-            self.handle(client_data, message)
+            size = client.recv_into(self.receive_buffer)
+            if not size: raise ConnectionError()
+            self.handle(client_data, self.receive_buffer[:size])
         except Exception as e:
             # Treat all errors as disconnections
             log.warning("Exception while handling read", exc_info=e)
             self.remove_client(client)
 
-    def send(self, client: socket.socket, message: bytes):
-        client.sendall(message)
+    def send(self, client: socket.socket, message: bytes) -> None:
+        if client in self.failed_clients:
+            return
+        pending = self.pending_sends.get(client)
+        if pending is None:
+            self.pending_sends[client] = [message]
+        else:
+            pending.append(message)
+
+    # Note: Sends never block; anything the socket won't take right away is queued and written once the socket is
+    # writable, so a slow client can't stall everyone else
+    def flush_sends(self) -> None:
+        pending_sends = self.pending_sends
+        self.pending_sends = dict()
+        for client, messages in pending_sends.items():
+            if client.fileno() < 0:
+                continue
+            self.send_now(client, messages[0] if len(messages) == 1 else b"".join(messages))
+
+    def send_now(self, client: socket.socket, message: bytes) -> None:
+        try:
+            queue = self.send_queues.get(client)
+            if queue is None:
+                try:
+                    sent = client.send(message)
+                except BlockingIOError:
+                    sent = 0
+                if sent == len(message):
+                    return
+                queue = self.send_queues[client] = bytearray()
+                self.selector.modify(client, selectors.EVENT_READ | selectors.EVENT_WRITE, self.clients[client])
+                message = memoryview(message)[sent:]
+            queue += message
+            if len(queue) > self.max_send_queue: raise ConnectionError("Send queue exceeded")
+        except Exception as e:
+            log.warning("Exception while sending; disconnecting client", exc_info=e)
+            self.failed_clients.add(client)
+
+    def write(self, client: socket.socket, client_data) -> None:
+        try:
+            queue = self.send_queues[client]
+            del queue[:client.send(queue)]
+            if not queue:
+                del self.send_queues[client]
+                self.selector.modify(client, selectors.EVENT_READ, client_data)
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            log.warning("Exception while handling write", exc_info=e)
+            self.remove_client(client)
 
     def enumerate_clients(self, excluded: socket.socket|None = None) -> list[tuple[socket.socket, type]]:
-        result = []
-        for _f, k in self.selector.get_map().items():
-            if not (k.fileobj == self.listener or k.fileobj == excluded):
-                assert isinstance(k.fileobj, socket.socket)
-                result.append((k.fileobj, k.data))
-        return result
+        return [(client, client_data) for client, client_data in self.clients.items() if client is not excluded]
 
     def create_client_data(self, client: socket.socket):
         raise NotImplementedError()
 
-    def handle(self, client_data, message: bytes) -> None:
+    def handle(self, client_data, message: memoryview) -> None:
+        """Note: message is only valid until this returns (the buffer is reused for the next read)"""
         raise NotImplementedError()
 
     def periodic_tasks(self) -> None:
         """Override this to perform periodic tasks like sending PINGs"""
         pass
 
-# IRC command parser
-command_pattern = r"^(?P<source>:[a-zA-Z0-9@#*_.+!\[\]{}\\|\-]+ )?(?P<command>[A-Za-z]+)(?P<subcommands>( +[a-zA-Z0-9@#*_.+!\[\]{}\\|\-]+)*?)( +:(?P<content>.*))?$"
+    def periodic_timeout(self) -> float|None:
+        """Override this to return the number of seconds until periodic tasks are next due (None to wait forever)"""
+        return 30
 
 # Validation patterns
 nickname_pattern = r"^[a-zA-Z\[\]\\`_\^\{\|\}][a-zA-Z0-9\[\]\\`_\^\{\|\}\-]{0,29}$"
 channel_pattern = r"^[#&][^\s,\x00-\x1f]{1,49}$"
 
+# Compiled once at import rather than on every call
+nickname_regex = re.compile(nickname_pattern)
+channel_regex = re.compile(channel_pattern)
+bind_info_regex = re.compile(r"^(?P<host>[^:]*?)(:(?P<port>[0-9]+))?$")
+
 def is_valid_nickname(nick: str) -> bool:
-    return bool(re.match(nickname_pattern, nick))
+    return bool(nickname_regex.match(nick))
 
 def is_valid_channel(channel: str) -> bool:
-    return bool(re.match(channel_pattern, channel))
+    return bool(channel_regex.match(channel))
+
+# IRC command parser
+# Note: Messages are "[:<source> ]<command>[ <subcommands>...][ :<content>]", so plain splitting is enough
+def decode_field(field: bytes) -> str:
+    try:
+        return field.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise SyntaxError("Invalid encoding in message!") from e
 
 class Command:
-    def __init__(self, text: str) -> None:
+    def __init__(self, line: bytes) -> None:
         # Parse message
-        match = re.match(command_pattern, text)
-        if not match: raise SyntaxError("Invalid message received!")
-        source = match["source"]
-        subcommands = match["subcommands"]
-        self.source = source[1:-1] if source else None
-        self.command = match["command"].upper()
-        self.subcommands = subcommands.split() if subcommands else None
-        self.content = match["content"]
+        source = None
+        if line.startswith(b":"):
+            source, _, line = line.partition(b" ")
+        line, separator, content = line.partition(b" :")
+        parts = line.split()
+        if not parts or not parts[0].isalpha(): raise SyntaxError("Invalid message received!")
+        self.source = decode_field(source[1:]) if source else None
+        self.command = parts[0].decode("ascii").upper()
+        self.subcommands = [decode_field(part) for part in parts[1:]] or None
+        self.raw_content = content if separator else None
+
+    # Note: Content is only decoded when needed, since PRIVMSG relays the raw bytes (which might not even be UTF-8,
+    # e.g. from older clients)
+    @property
+    def content(self) -> str|None:
+        return self.raw_content.decode("utf-8", errors="replace") if self.raw_content is not None else None
     
     def __repr__(self):
         return f"Command: {self.command}, Subcommands: {repr(self.subcommands)}, Content: {self.content}"
 
 # IRC client representation
+# Note: Maps every byte value to a letter, so random IDs are one urandom() call and one translate() (the slight bias
+# towards the start of the alphabet doesn't matter for default names)
+random_id_table = bytes.maketrans(bytes(range(256)), (string.ascii_lowercase.encode("ascii") * 10)[:256])
+
 def random_id() -> str:
-    return "".join(random.choices(string.ascii_lowercase, k=7))
+    return os.urandom(7).translate(random_id_table).decode("ascii")
 
 def compute_id(nick: str, user: str, host: str) -> str:
     return f"{nick}!{user}@{host}"
 
 class ClientRegistration:
+    # Note: Slots make each client smaller and quicker to create than with a per-instance __dict__
+    __slots__ = ("client", "nick", "nick_set", "user", "host", "channels", "last_ping_time", "received", "cached_id", "id_bytes", "nick_bytes")
+
     def __init__(self, client: socket.socket) -> None:
         self.client = client
         self.nick = f"n{random_id()}"
         self.nick_set = False
         self.user = f"u{random_id()}"
         self.host = f"h{random_id()}"
-        self.channels = []
+        self.channels: set[str] = set()
         self.last_ping_time = time.time()
+        self.received = bytearray()
+        self.update_id()
+
+    # Note: The id prefixes most outgoing messages (and the nick is in every numeric reply), so they're cached in
+    # encoded form (and must be updated when nick/user/host change)
+    def update_id(self) -> None:
+        self.cached_id = compute_id(self.nick, self.user, self.host)
+        self.id_bytes = self.cached_id.encode("utf-8")
+        self.nick_bytes = self.nick.encode("utf-8")
 
     def id(self) -> str:
-        return compute_id(self.nick, self.user, self.host)
+        return self.cached_id
+
+# IRC channel representation
+class Channel:
+    __slots__ = ("members", "names", "who")
+
+    def __init__(self) -> None:
+        # Note: Members are kept as dict keys for O(1) membership checks/removal, while preserving join order
+        self.members: dict[ClientRegistration, None] = dict()
+        # Cached NAMES/WHO reply text, rebuilt on demand after membership (or a member's nick/user) changes
+        self.names: str|None = None
+        self.who: list[str]|None = None
+
+    def invalidate(self) -> None:
+        self.names = None
+        self.who = None
+
+    # Note: Joining only appends a nick, so the cached NAMES text is extended rather than rebuilt on every JOIN
+    def add_member(self, client_data: ClientRegistration) -> None:
+        self.members[client_data] = None
+        if self.names is not None:
+            self.names = f"{self.names} {client_data.nick}" if self.names else client_data.nick
+        self.who = None
+
+    def get_names(self) -> str:
+        if self.names is None:
+            self.names = " ".join([c.nick for c in self.members])
+        return self.names
 
 # IRC numeric replies
 class Reply(Enum):
@@ -163,6 +337,9 @@ class Reply(Enum):
     NicknameInUse = 433
     BadChannelName = 479
 
+# Zero-padded numeric codes (e.g. b"001"), so they aren't reformatted for every reply
+numeric_codes = {reply: f"{reply.value:03d}".encode("ascii") for reply in Reply}
+
 # Server
 class IrcServer(TcpServer):
     def __init__(
@@ -177,39 +354,77 @@ class IrcServer(TcpServer):
         super().__init__(host, port, 512, max_pending_clients)
         self.network_name = network_name
         self.server_name = server_name
+        self.server_prefix = f":{server_name} ".encode("utf-8")
+        # Encoded ":<server> <numeric> " prefix for each reply
+        self.numeric_prefixes = {reply: self.server_prefix + code + b" " for reply, code in numeric_codes.items()}
         self.version = 0.1
-        self.channels: dict[str, list[ClientRegistration]] = dict()
+        self.channels: dict[str, Channel] = dict()
         self.topics: dict[str, str] = dict()
         self.users: dict[str, ClientRegistration] = dict()
+        # Min-heap of (due time, tie breaker, client), so only clients that are due for a PING get looked at
+        self.ping_interval = 60
+        self.ping_schedule: list[tuple[float, int, ClientRegistration]] = []
+        self.ping_counter = itertools.count()
         self.motd = []
         for line in motd:
             for l in (textwrap.wrap(line) if line else [""]):
                 self.motd.append(l)
+        self.motd_parts = self.encode_split(self.motd_replies())
+        # Everything after the (client specific) welcome line is fixed, so it's encoded once along with the MOTD
+        self.welcome_parts = self.encode_split([
+            (Reply.YourHost,    f":Your host is {self.server_name}, running version {self.version}"),
+            (Reply.Created,     ":This server was created today"),
+            (Reply.MyInfo,      f"{self.server_name} {self.version}  "),
+            (Reply.ISupport,    f"NETWORK={self.network_name} :are supported by this server"),
+            *self.motd_replies(),
+        ])
+        self.command_handlers = {
+            "CAP": self.handle_cap,
+            "NICK": self.handle_nick,
+            "USER": self.handle_user,
+            "MOTD": self.handle_motd,
+            "PING": self.handle_ping,
+            "PONG": self.handle_pong,
+            "JOIN": self.handle_join,
+            "QUIT": self.handle_quit,
+            "PART": self.handle_part,
+            "LIST": self.handle_list,
+            "WHOIS": self.handle_whois,
+            "TOPIC": self.handle_topic,
+            "PRIVMSG": self.handle_privmsg,
+            "MODE": self.handle_mode,
+            "WHO": self.handle_who,
+        }
 
     def encode(self, message: str) -> bytes:
         return f"{message}\r\n".encode("utf-8")
 
     def send_text_each(self, clients: Iterable[ClientRegistration], message: str, excluded: ClientRegistration|None = None) -> None:
-        log.debug(f"-->  {message}")
-        encoded_message = self.encode(message)
+        log.debug("-->  %s", message)
+        self.send_encoded_each(clients, self.encode(message), excluded)
+
+    def send_encoded_each(self, clients: Iterable[ClientRegistration], encoded_message: bytes, excluded: ClientRegistration|None = None) -> None:
+        # Note: Every recipient is sent the same bytes object (no copies), and the bound method is looked up only once
+        send = self.send
         for client_data in clients:
-            if not client_data == excluded:
-                try:
-                    self.send(client_data.client, encoded_message)
-                except Exception as e:
-                    log.warning("Exception while sending; disconnecting client", exc_info=e)
-                    self.remove_client(client_data.client)
+            if client_data is not excluded:
+                send(client_data.client, encoded_message)
 
     def create_client_data(self, client: socket.socket) -> ClientRegistration:
         client_data = ClientRegistration(client)
         self.users[client_data.nick.lower()] = client_data
+        self.schedule_ping(client_data, client_data.last_ping_time + self.ping_interval)
         return client_data
     
-    def handle(self, client_data: ClientRegistration, message: bytes) -> None:
-        text = message.decode("utf-8")
-        lines = text.strip().split("\r\n")
-        for line in lines:
-            log.debug(f"<-- {line}")
+    def handle(self, client_data: ClientRegistration, message: memoryview) -> None:
+        # TCP doesn't preserve message boundaries, so only complete lines are handled and any partial line is
+        # kept until the rest of it arrives (bare "\n" line endings are accepted too)
+        buffer = client_data.received
+        buffer += message
+        while (end := buffer.find(b"\n")) >= 0:
+            line = bytes(buffer[:end]).rstrip(b"\r")
+            del buffer[:end + 1]
+            log.debug("<-- %s", line)
             # Skip empty lines
             if not line.strip():
                 continue
@@ -217,289 +432,376 @@ class IrcServer(TcpServer):
                 self.handle_command(client_data, Command(line))
             except SyntaxError as e:
                 log.warning(f"Failed to parse command from {client_data.id()}: {repr(line)}", exc_info=e)
+            # Stop if the command disconnected the client (e.g. QUIT)
+            if client_data.client.fileno() < 0:
+                return
+        if len(buffer) > 2 * self.max_message_size:
+            raise ConnectionError("Line too long")
     
     def reply(self, client_data: ClientRegistration, text: str) -> None:
         self.send_text_each([client_data], text)
 
+    def encode_numeric(self, client_data: ClientRegistration, reply: Reply, text: str) -> bytes:
+        message = b"".join([self.numeric_prefixes[reply], client_data.nick_bytes, b" ", text.encode("utf-8"), b"\r\n"])
+        log.debug("-->  %s", message)
+        return message
+
     def reply_numeric(self, client_data: ClientRegistration, reply: Reply, text: str) -> None:
-        self.reply(client_data, f":{self.server_name} {str(reply.value).zfill(3)} {client_data.nick} {text}")
+        self.send(client_data.client, self.encode_numeric(client_data, reply, text))
+
+    def encode_numerics(self, client_data: ClientRegistration, replies: list[tuple[Reply, str]]) -> bytes:
+        return b"".join([self.encode_numeric(client_data, reply, text) for reply, text in replies])
 
     def reply_numerics(self, client_data: ClientRegistration, replies: list[tuple[Reply, str]]) -> None:
-        for reply, text in replies:
-            self.reply_numeric(client_data, reply, text)
+        # Send all lines at once, rather than one send (syscall and TCP segment) per line
+        self.send(client_data.client, self.encode_numerics(client_data, replies))
 
-    def channel_get(self, channel: str) -> list[ClientRegistration]:
-        channel_lower = channel.lower()
+    # Note: The channel helpers below expect channel names that have already been lowercased by the caller
+    def channel_get(self, channel_lower: str) -> Channel:
         if not channel_lower in self.channels:
-            self.channels[channel_lower] = []
+            self.channels[channel_lower] = Channel()
         return self.channels[channel_lower]
     
     # Note: Needed a safe way to retrieve members of a channel, even if a channel was just deleted
-    def channel_get_members(self, channel: str) -> list[ClientRegistration]:
-        channel_lower = channel.lower()
-        return self.channels[channel_lower] if channel_lower in self.channels else []
+    def channel_get_members(self, channel_lower: str) -> dict[ClientRegistration, None]:
+        return self.channels[channel_lower].members if channel_lower in self.channels else {}
 
-    def leave_channel(self, client_data: ClientRegistration, channel: str):
-        channel_lower = channel.lower()
+    def leave_channel(self, client_data: ClientRegistration, channel_lower: str):
         if channel_lower in self.channels:
-            channel_list = self.channels[channel_lower]
-            if client_data in channel_list:
-                channel_list.remove(client_data)
-                if len(channel_list) <= 0:
+            channel_data = self.channels[channel_lower]
+            if client_data in channel_data.members:
+                del channel_data.members[client_data]
+                channel_data.invalidate()
+                if len(channel_data.members) <= 0:
                     del self.channels[channel_lower]
                     # Clean up topic when channel is empty
                     if channel_lower in self.topics:
                         del self.topics[channel_lower]
-        if channel_lower in client_data.channels:
-            client_data.channels.remove(channel_lower)
+        client_data.channels.discard(channel_lower)
 
     def remove_client(self, client: socket.socket, reason = "") -> None:
         # Need to also remove from user/channel dictionaries and send QUIT messages
-        key = self.selector.get_map().get(client)
-        client_data = key.data if key else None
+        client_data = cast(ClientRegistration|None, self.clients.get(client))
         super().remove_client(client)
         if client_data:
             # Remove from user list
-            assert isinstance(client_data, ClientRegistration)
-            if client_data.nick.lower() in self.users:
-                del self.users[client_data.nick.lower()]
+            self.users.pop(client_data.nick.lower(), None)
             # Remove from channels
-            neighbors = set()
-            for channel in client_data.channels:
+            neighbors: set[ClientRegistration] = set()
+            # Note: Iterate over a copy, since leaving a channel removes it from client_data.channels
+            for channel in list(client_data.channels):
                 if channel in self.channels:
                     self.leave_channel(client_data, channel)
-                    neighbors = neighbors.union(self.channel_get_members(channel))
+                    # Note: Add in place, rather than copying the whole set for every channel (as union() does)
+                    neighbors.update(self.channel_get_members(channel))
             # Send QUIT updates to interested (i.e. in shared channel) clients
             self.send_text_each(neighbors, f":{client_data.id()} QUIT :Quit: {reason}")
             log.info(f"User disconnected: {client_data.id()}")
 
-    def send_motd(self, client_data: ClientRegistration) -> None:
+    # Note: Needed whenever a client's nick/user changes, since channels cache replies that include them
+    def invalidate_channels(self, client_data: ClientRegistration) -> None:
+        for channel in client_data.channels:
+            if channel in self.channels:
+                self.channels[channel].invalidate()
+
+    def motd_replies(self) -> list[tuple[Reply, str]]:
         if self.motd:
-            for i, line in enumerate(self.motd):
-                self.reply_numeric(client_data, Reply.MotdStart if i == 0 else Reply.Motd, f":- {line}")
-            self.reply_numeric(client_data, Reply.EndOfMotd, ":-")
+            replies = [(Reply.MotdStart if i == 0 else Reply.Motd, f":- {line}") for i, line in enumerate(self.motd)]
+            replies.append((Reply.EndOfMotd, ":-"))
         else:
-            self.reply_numeric(client_data, Reply.NoMotd, ":MOTD File is missing")
+            replies = [(Reply.NoMotd, ":MOTD File is missing")]
+        return replies
+
+    # Note: Replies that never change (like the MOTD) are encoded once, split around the spots where each client's
+    # nick goes (so sending them is just one join and one send)
+    def encode_split(self, replies: list[tuple[Reply, str]]) -> list[bytes]:
+        parts = []
+        suffix = b""
+        for reply, text in replies:
+            parts.append(suffix + self.numeric_prefixes[reply])
+            suffix = b" " + text.encode("utf-8") + b"\r\n"
+        parts.append(suffix)
+        return parts
 
-    def send_topic(self, client_data: ClientRegistration, channel: str) -> None:
+    def encode_motd_for(self, client_data: ClientRegistration) -> bytes:
+        message = client_data.nick_bytes.join(self.motd_parts)
+        log.debug("-->  %s", message)
+        return message
+
+    def send_motd(self, client_data: ClientRegistration) -> None:
+        self.send(client_data.client, self.encode_motd_for(client_data))
+
+    def topic_reply(self, channel: str) -> tuple[Reply, str]:
         if channel in self.topics and self.topics[channel]:
-            self.reply_numeric(client_data, Reply.Topic, f"{channel} :{self.topics[channel]}")
+            return (Reply.Topic, f"{channel} :{self.topics[channel]}")
         else:
-            self.reply_numeric(client_data, Reply.NoTopicSet, f"{channel} :No topic is set")
+            return (Reply.NoTopicSet, f"{channel} :No topic is set")
+
+    def send_topic(self, client_data: ClientRegistration, channel: str) -> None:
+        self.reply_numeric(client_data, *self.topic_reply(channel))
+
+    def schedule_ping(self, client_data: ClientRegistration, due_time: float) -> None:
+        heapq.heappush(self.ping_schedule, (due_time, next(self.ping_counter), client_data))
 
     def periodic_tasks(self) -> None:
         """Send periodic PINGs to clients"""
         current_time = time.time()
-        ping_interval = 60  # Send PING every 60 seconds
-
-        for client_socket, client_data in self.enumerate_clients():
-            if isinstance(client_data, ClientRegistration):
-                if current_time - client_data.last_ping_time >= ping_interval:
-                    try:
-                        self.reply(client_data, f"PING :{self.server_name}")
-                        client_data.last_ping_time = current_time
-                        log.debug(f"Sent PING to {client_data.id()}")
-                    except Exception as e:
-                        log.warning(f"Failed to send PING to {client_data.id()}", exc_info=e)
-
+        while self.ping_schedule and self.ping_schedule[0][0] <= current_time:
+            _due_time, _, client_data = heapq.heappop(self.ping_schedule)
+            # Note: Disconnected clients are dropped from the schedule here, rather than searched for on disconnect
+            if client_data.client.fileno() < 0:
+                continue
+            # A PONG since this was scheduled pushes the next PING back
+            due_time = client_data.last_ping_time + self.ping_interval
+            if due_time <= current_time:
+                self.reply(client_data, f"PING :{self.server_name}")
+                client_data.last_ping_time = current_time
+                log.debug("Sent PING to %s", client_data.id())
+                due_time = current_time + self.ping_interval
+            self.schedule_ping(client_data, due_time)
+
+    def periodic_timeout(self) -> float|None:
+        if not self.ping_schedule:
+            return None
+        return max(0, self.ping_schedule[0][0] - time.time())
+
+    # Note: Commands are dispatched through a dict (one lookup) rather than a match statement (compared one case at a time)
     def handle_command(self, client_data: ClientRegistration, command: Command) -> None:
-        match command.command:
-            case "CAP":
-                if command.subcommands:
-                    match command.subcommands[0]:
-                        case "LS":
-                            self.reply(client_data, "CAP * ACK")
-            case "NICK":
-                if command.subcommands and len(command.subcommands) >= 1:
-                    nick = command.subcommands[0]
-                    if not is_valid_nickname(nick):
-                        self.reply_numeric(client_data, Reply.ErroneousNickname, f"{nick} :Erroneous nickname")
-                    elif nick.lower() in self.users:
-                        self.reply_numeric(client_data, Reply.NicknameInUse, ":Nickname already in use")
-                    else:
-                        old_nick = client_data.nick
-                        if old_nick.lower() in self.users: del self.users[old_nick.lower()]
-                        client_data.nick = nick
-                        self.users[nick.lower()] = client_data
-                        if client_data.nick_set:
-                            # Find all users in shared channels to notify them of the nick change
-                            neighbors = set([client_data])  # Include self
-                            for channel in client_data.channels:
-                                if channel in self.channels:
-                                    neighbors.update(self.channels[channel])
-                            self.send_text_each(neighbors, f":{compute_id(old_nick, client_data.user, client_data.host)} NICK {nick}")
-                        client_data.nick_set = True
-            case "USER":
-                if command.subcommands and len(command.subcommands) >= 1:
-                    client_data.user = command.subcommands[0]
+        self.command_handlers.get(command.command, self.handle_unknown)(client_data, command)
+
+    def handle_cap(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands:
+            match command.subcommands[0]:
+                case "LS":
+                    self.reply(client_data, "CAP * ACK")
+
+    def handle_nick(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands and len(command.subcommands) >= 1:
+            nick = command.subcommands[0]
+            nick_lower = nick.lower()
+            if not is_valid_nickname(nick):
+                self.reply_numeric(client_data, Reply.ErroneousNickname, f"{nick} :Erroneous nickname")
+            elif nick_lower in self.users:
+                self.reply_numeric(client_data, Reply.NicknameInUse, ":Nickname already in use")
+            else:
+                old_id = client_data.id()
+                self.users.pop(client_data.nick.lower(), None)
+                client_data.nick = nick
+                client_data.update_id()
+                self.users[nick_lower] = client_data
+                self.invalidate_channels(client_data)
+                if client_data.nick_set:
+                    # Find all users in shared channels to notify them of the nick change
+                    neighbors = {client_data}  # Include self
+                    for channel in client_data.channels:
+                        if channel in self.channels:
+                            neighbors.update(self.channels[channel].members)
+                    self.send_text_each(neighbors, f":{old_id} NICK {nick}")
+                client_data.nick_set = True
+
+    def handle_user(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands and len(command.subcommands) >= 1:
+            client_data.user = command.subcommands[0]
+            client_data.update_id()
+            self.invalidate_channels(client_data)
+            # Note: The welcome burst and MOTD go out together, in a single send
+            welcome = self.encode_numeric(client_data, Reply.Welcome, f":Welcome, {client_data.id()}")
+            rest = client_data.nick_bytes.join(self.welcome_parts)
+            log.debug("-->  %s", rest)
+            self.send(client_data.client, welcome + rest)
+            log.info(f"New user connected: {client_data.id()}")
+
+    def handle_motd(self, client_data: ClientRegistration, command: Command) -> None:
+        self.send_motd(client_data)
+
+    def handle_ping(self, client_data: ClientRegistration, command: Command) -> None:
+        # Handle both "PING :token" and "PING token" formats
+        # Proper IRC format: PONG <server> :token
+        if command.content:
+            self.reply(client_data, f':{self.server_name} PONG {self.server_name} :{command.content}')
+        elif command.subcommands:
+            token = " ".join(command.subcommands)
+            self.reply(client_data, f':{self.server_name} PONG {self.server_name} :{token}')
+
+    def handle_pong(self, client_data: ClientRegistration, command: Command) -> None:
+        # Client responded to our PING - update last activity time
+        client_data.last_ping_time = time.time()
+
+    def handle_join(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands:
+            channels = command.subcommands[0].split(",")
+            for channel in channels:
+                channel_lower = channel.lower()
+                # Note: Existing channels were validated when they were created, so only new names need checking
+                if channel_lower not in self.channels and not is_valid_channel(channel):
+                    self.reply_numeric(client_data, Reply.BadChannelName, f"{channel} :Bad channel name")
+                elif channel_lower in client_data.channels:
+                    # Already in channel, just send the current state
+                    channel_data = self.channel_get(channel_lower)
                     self.reply_numerics(client_data, [
-                        (Reply.Welcome,     f":Welcome, {client_data.id()}"),
-                        (Reply.YourHost,    f":Your host is {self.server_name}, running version {self.version}"),
-                        (Reply.Created,     ":This server was created today"),
-                        (Reply.MyInfo,      f"{self.server_name} {self.version}  "),
-                        (Reply.ISupport,    f"NETWORK={self.network_name} :are supported by this server"),
+                        self.topic_reply(channel_lower),
+                        (Reply.NameReply, f"= {channel_lower} :{channel_data.get_names()}"),
+                        (Reply.EndOfNames, f"{channel_lower} :End of /NAMES list"),
                     ])
-                    self.send_motd(client_data)
-                    log.info(f"New user connected: {client_data.id()}")
-            case "MOTD":
-                self.send_motd(client_data)
-            case "PING":
-                # Handle both "PING :token" and "PING token" formats
-                # Proper IRC format: PONG <server> :token
-                if command.content:
-                    self.reply(client_data, f':{self.server_name} PONG {self.server_name} :{command.content}')
-                elif command.subcommands:
-                    token = " ".join(command.subcommands)
-                    self.reply(client_data, f':{self.server_name} PONG {self.server_name} :{token}')
-            case "PONG":
-                # Client responded to our PING - update last activity time
-                client_data.last_ping_time = time.time()
-            case "JOIN":
-                if command.subcommands:
-                    channels = command.subcommands[0].split(",")
-                    for channel in channels:
-                        if not is_valid_channel(channel):
-                            self.reply_numeric(client_data, Reply.BadChannelName, f"{channel} :Bad channel name")
-                        else:
-                            channel_lower = channel.lower()
-                            if channel_lower in client_data.channels:
-                                # Already in channel, just send the current state
-                                clients = self.channel_get(channel_lower)
-                                self.send_topic(client_data, channel_lower)
-                                self.reply_numerics(client_data, [
-                                    (Reply.NameReply, f"= {channel_lower} :{' '.join([c.nick for c in clients])}"),
-                                    (Reply.EndOfNames, f"{channel_lower} :End of /NAMES list"),
-                                ])
-                            else:
-                                # Join the channel
-                                client_data.channels.append(channel_lower)
-                                clients = self.channel_get(channel_lower)
-                                clients.append(client_data)
-                                self.send_text_each(clients, f":{client_data.id()} JOIN {channel_lower}")
-                                # TODO: Split nick list, if needed
-                                self.send_topic(client_data, channel_lower)
-                                self.reply_numerics(client_data, [
-                                    (Reply.NameReply, f"= {channel_lower} :{' '.join([c.nick for c in clients])}"),
-                                    (Reply.EndOfNames, f"{channel_lower} :End of /NAMES list"),
-                                ])
-            case "QUIT":
-                self.remove_client(client_data.client, command.content if command.content else "")
-            case "PART":
-                if command.subcommands and len(command.subcommands) >= 1:
-                    channels = command.subcommands[0].split(",")
-                    for channel in channels:
-                        channel_lower = channel.lower()
-                        if len(channel) >= 1 and channel[0] == "#" and channel_lower in self.channels and channel_lower in client_data.channels:
-                            self.leave_channel(client_data, channel_lower)
-                            self.send_text_each([client_data, *self.channel_get_members(channel_lower)], f":{client_data.id()} PART {channel_lower}")
-            case "LIST":
-                self.reply_numeric(client_data, Reply.ListStart, "Channel :Users  Name")
-                for channel, clients in self.channels.items():
-                    self.reply_numeric(client_data, Reply.List, f"{channel} {len(clients)} :")
-                self.reply_numeric(client_data, Reply.ListEnd, "End of /LIST")
-            case "WHOIS":
-                if command.subcommands and len(command.subcommands) >= 1:
-                    target_nick = command.subcommands[0]
-                    if target_nick.lower() in self.users:
-                        target_user = self.users[target_nick.lower()]
-                        self.reply_numerics(client_data, [
-                            (Reply.WhoisUser, f"{target_user.nick} {target_user.user} {target_user.host} * :User"),
-                            (Reply.WhoisServer, f"{target_user.nick} {self.server_name} :{self.network_name}"),
-                            (Reply.EndOfWhois, f"{target_nick} :End of /WHOIS list"),
-                        ])
-                    else:
-                        self.reply_numerics(client_data, [
-                            (Reply.NoSuchNick, f"{target_nick} :No such nick/channel"),
-                            (Reply.EndOfWhois, f"{target_nick} :End of /WHOIS list"),
-                        ])
-            case "TOPIC":
-                if command.subcommands and len(command.subcommands) >= 1:
-                    channel = command.subcommands[0]
-                    channel_lower = channel.lower()
-                    if channel_lower not in self.channels:
-                        self.reply_numeric(client_data, Reply.NoSuchChannel, f"{channel} :No such channel")
-                    elif channel_lower not in client_data.channels:
-                        self.reply_numeric(client_data, Reply.NoSuchChannel, f"{channel} :You're not on that channel")
-                    elif command.content is not None:
-                        # Set topic
-                        self.topics[channel_lower] = command.content
-                        # Broadcast to all users in channel
-                        self.send_text_each(self.channels[channel_lower], f":{client_data.id()} TOPIC {channel_lower} :{command.content}")
-                    else:
-                        # View topic
-                        self.send_topic(client_data, channel_lower)
-            case "PRIVMSG":
-                if command.subcommands and len(command.subcommands) >= 1:
-                    targets = command.subcommands[0].split(",")
-                    for target in targets:
-                        if len(target) >= 1 and target[0] == "#":
-                            target_lower = target.lower()
-                            if target_lower in self.channels and client_data in self.channels[target_lower]:
-                                message = f":{client_data.id()} PRIVMSG {target_lower} :{command.content}"
-                                self.send_text_each(self.channels[target_lower], message, client_data)
-                        else:
-                            if target.lower() in self.users:
-                                message = f":{client_data.id()} PRIVMSG {target} :{command.content}"
-                                self.send_text_each([self.users[target.lower()]], message)
-                            else:
-                                self.reply_numeric(client_data, Reply.NoSuchNick, f"{target} :No such nick/channel")
-            case "MODE":
-                # MODE command - for now, just acknowledge without actually applying modes
-                if command.subcommands and len(command.subcommands) >= 1:
-                    target = command.subcommands[0]
-                    # If querying channel modes, return simple +nt
-                    if len(target) >= 1 and target[0] == "#":
-                        channel_lower = target.lower()
-                        if channel_lower in self.channels:
-                            self.reply(client_data, f":{self.server_name} 324 {client_data.nick} {channel_lower} +nt")
-                    # Otherwise silently ignore mode changes (no error)
-            case "WHO":
-                # WHO command - return info about users in a channel or matching a pattern
-                if command.subcommands and len(command.subcommands) >= 1:
-                    target = command.subcommands[0]
-                    if len(target) >= 1 and target[0] == "#":
-                        # WHO for channel
-                        channel_lower = target.lower()
-                        if channel_lower in self.channels:
-                            for user in self.channels[channel_lower]:
-                                # Format: <channel> <user> <host> <server> <nick> <H|G> :<hopcount> <realname>
-                                self.reply_numeric(client_data, Reply.WhoReply,
-                                    f"{channel_lower} {user.user} {user.host} {self.server_name} {user.nick} H :0 User")
-                        self.reply_numeric(client_data, Reply.EndOfWho, f"{target} :End of /WHO list")
+                else:
+                    # Join the channel
+                    client_data.channels.add(channel_lower)
+                    channel_data = self.channel_get(channel_lower)
+                    channel_data.add_member(client_data)
+                    self.send_text_each(channel_data.members, f":{client_data.id()} JOIN {channel_lower}")
+                    # TODO: Split nick list, if needed
+                    self.reply_numerics(client_data, [
+                        self.topic_reply(channel_lower),
+                        (Reply.NameReply, f"= {channel_lower} :{channel_data.get_names()}"),
+                        (Reply.EndOfNames, f"{channel_lower} :End of /NAMES list"),
+                    ])
+
+    def handle_quit(self, client_data: ClientRegistration, command: Command) -> None:
+        self.remove_client(client_data.client, command.content if command.content else "")
+
+    def handle_part(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands and len(command.subcommands) >= 1:
+            channels = command.subcommands[0].split(",")
+            for channel in channels:
+                channel_lower = channel.lower()
+                if len(channel) >= 1 and channel[0] == "#" and channel_lower in self.channels and channel_lower in client_data.channels:
+                    self.leave_channel(client_data, channel_lower)
+                    self.send_text_each([client_data, *self.channel_get_members(channel_lower)], f":{client_data.id()} PART {channel_lower}")
+
+    def handle_list(self, client_data: ClientRegistration, command: Command) -> None:
+        # Note: The whole list goes out in a single send, rather than one per channel
+        self.reply_numerics(client_data, [
+            (Reply.ListStart, "Channel :Users  Name"),
+            *[(Reply.List, f"{channel} {len(channel_data.members)} :") for channel, channel_data in self.channels.items()],
+            (Reply.ListEnd, "End of /LIST"),
+        ])
+
+    def handle_whois(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands and len(command.subcommands) >= 1:
+            target_nick = command.subcommands[0]
+            target_user = self.users.get(target_nick.lower())
+            if target_user:
+                self.reply_numerics(client_data, [
+                    (Reply.WhoisUser, f"{target_user.nick} {target_user.user} {target_user.host} * :User"),
+                    (Reply.WhoisServer, f"{target_user.nick} {self.server_name} :{self.network_name}"),
+                    (Reply.EndOfWhois, f"{target_nick} :End of /WHOIS list"),
+                ])
+            else:
+                self.reply_numerics(client_data, [
+                    (Reply.NoSuchNick, f"{target_nick} :No such nick/channel"),
+                    (Reply.EndOfWhois, f"{target_nick} :End of /WHOIS list"),
+                ])
+
+    def handle_topic(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands and len(command.subcommands) >= 1:
+            channel = command.subcommands[0]
+            channel_lower = channel.lower()
+            if channel_lower not in self.channels:
+                self.reply_numeric(client_data, Reply.NoSuchChannel, f"{channel} :No such channel")
+            elif channel_lower not in client_data.channels:
+                self.reply_numeric(client_data, Reply.NoSuchChannel, f"{channel} :You're not on that channel")
+            elif command.content is not None:
+                # Set topic
+                self.topics[channel_lower] = command.content
+                # Broadcast to all users in channel
+                self.send_text_each(self.channels[channel_lower].members, f":{client_data.id()} TOPIC {channel_lower} :{command.content}")
+            else:
+                # View topic
+                self.send_topic(client_data, channel_lower)
+
+    def handle_privmsg(self, client_data: ClientRegistration, command: Command) -> None:
+        if command.subcommands and len(command.subcommands) >= 1:
+            # Note: Duplicate targets are dropped (ignoring case, keeping the first spelling), so "PRIVMSG #a,#A" is only
+            # delivered once
+            targets: dict[str, str] = dict()
+            for target in command.subcommands[0].split(","):
+                targets.setdefault(target.lower(), target)
+            # Note: Messages are assembled from bytes, since this is the most frequent (and most broadcast) command
+            prefix = b":" + client_data.id_bytes + b" PRIVMSG "
+            suffix = b" :" + (command.raw_content or b"") + b"\r\n"
+            for target_lower, target in targets.items():
+                if len(target) >= 1 and target[0] == "#":
+                    if target_lower in self.channels and client_data in self.channels[target_lower].members:
+                        message = prefix + target_lower.encode("utf-8") + suffix
+                        log.debug("-->  %s", message)
+                        self.send_encoded_each(self.channels[target_lower].members, message, client_data)
+                else:
+                    target_user = self.users.get(target_lower)
+                    if target_user:
+                        message = prefix + target.encode("utf-8") + suffix
+                        log.debug("-->  %s", message)
+                        self.send(target_user.client, message)
                     else:
-                        # WHO for specific user
-                        if target.lower() in self.users:
-                            user = self.users[target.lower()]
-                            # Find a channel they're in (if any)
-                            channel = user.channels[0] if user.channels else "*"
-                            self.reply_numeric(client_data, Reply.WhoReply,
-                                f"{channel} {user.user} {user.host} {self.server_name} {user.nick} H :0 User")
-                        self.reply_numeric(client_data, Reply.EndOfWho, f"{target} :End of /WHO list")
-            case _:
-                # Unknown command
-                self.reply_numeric(client_data, Reply.UnknownCommand, f"{command.command} :Unknown command")
+                        self.reply_numeric(client_data, Reply.NoSuchNick, f"{target} :No such nick/channel")
+
+    def handle_mode(self, client_data: ClientRegistration, command: Command) -> None:
+        # MODE command - for now, just acknowledge without actually applying modes
+        if command.subcommands and len(command.subcommands) >= 1:
+            target = command.subcommands[0]
+            # If querying channel modes, return simple +nt
+            if len(target) >= 1 and target[0] == "#":
+                channel_lower = target.lower()
+                if channel_lower in self.channels:
+                    self.reply(client_data, f":{self.server_name} 324 {client_data.nick} {channel_lower} +nt")
+            # Otherwise silently ignore mode changes (no error)
+
+    def handle_who(self, client_data: ClientRegistration, command: Command) -> None:
+        # WHO command - return info about users in a channel or matching a pattern
+        if command.subcommands and len(command.subcommands) >= 1:
+            target = command.subcommands[0]
+            if len(target) >= 1 and target[0] == "#":
+                # WHO for channel
+                channel_lower = target.lower()
+                replies = []
+                if channel_lower in self.channels:
+                    channel_data = self.channels[channel_lower]
+                    if channel_data.who is None:
+                        # Format: <channel> <user> <host> <server> <nick> <H|G> :<hopcount> <realname>
+                        channel_data.who = [f"{channel_lower} {user.user} {user.host} {self.server_name} {user.nick} H :0 User"
+                                            for user in channel_data.members]
+                    replies = [(Reply.WhoReply, line) for line in channel_data.who]
+                replies.append((Reply.EndOfWho, f"{target} :End of /WHO list"))
+                self.reply_numerics(client_data, replies)
+            else:
+                # WHO for specific user
+                user = self.users.get(target.lower())
+                if user:
+                    # Find a channel they're in (if any)
+                    channel = next(iter(user.channels), "*")
+                    self.reply_numeric(client_data, Reply.WhoReply,
+                        f"{channel} {user.user} {user.host} {self.server_name} {user.nick} H :0 User")
+                self.reply_numeric(client_data, Reply.EndOfWho, f"{target} :End of /WHO list")
+
+    def handle_unknown(self, client_data: ClientRegistration, command: Command) -> None:
+        # Unknown command
+        self.reply_numeric(client_data, Reply.UnknownCommand, f"{command.command} :Unknown command")
 
 def print_usage():
     print(f"\nUSAGE: {sys.argv[0]} <host/IP>[:<port>] [MOTD file]\n")
 
-if len(sys.argv) <= 1 or sys.argv[1] == "--help":
-    print_usage()
-    exit(0)
-
-motd = []
-if len(sys.argv) >= 3:
-    with open(sys.argv[2]) as f:
-        motd = f.read().splitlines()
-
-bind_info = re.match(r"^(?P<host>[^:]*?)(:(?P<port>[0-9]+))?$", sys.argv[1])
-if (not bind_info):
-    print(f"ERROR: couldn't parse bind info: \"{sys.argv[1]}\"")
-    print_usage()
-    exit(-1)
-
-server = IrcServer(host=bind_info["host"], port=int(bind_info["port"] or 6667), motd=motd)
-try:
-    server.run()
-except KeyboardInterrupt:
-    log.info("Server shutting down...")
-    exit(0)
+def main() -> None:
+    if len(sys.argv) <= 1 or sys.argv[1] == "--help":
+        print_usage()
+        exit(0)
+
+    motd = []
+    if len(sys.argv) >= 3:
+        with open(sys.argv[2]) as f:
+            motd = f.read().splitlines()
+
+    bind_info = bind_info_regex.match(sys.argv[1])
+    if (not bind_info):
+        print(f"ERROR: couldn't parse bind info: \"{sys.argv[1]}\"")
+        print_usage()
+        exit(-1)
+
+    server = IrcServer(host=bind_info["host"], port=int(bind_info["port"] or 6667), motd=motd)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        log.info("Server shutting down...")
+        exit(0)
+
+# Note: Only start the server when run as a script, so importing this module (e.g. for profiling) has no side effects
+if __name__ == "__main__":
+    main()